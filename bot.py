@@ -2,6 +2,7 @@ import asyncio
 import logging
 from pathlib import Path
 
+import uvloop
 from telegram import Update
 from telegram.ext import (
     Application,
@@ -11,9 +12,12 @@ from telegram.ext import (
     filters
 )
 
-from config import BOT_TOKEN, TEMP_DIR
-from utils import cleanup_temp_files, is_supported_format
-from queue_handler import QueueManager, VideoJob
+from config import (
+    BOT_TOKEN, TEMP_DIR, MAX_QUEUE_SIZE,
+    TEMP_CLEANUP_INTERVAL, TEMP_FILE_MAX_AGE
+)
+from utils import cleanup_temp_files, detect_hw_encoder, is_supported_format
+from queue_handler import QueueManager, QueueFullError, VideoJob
 
 # Configure logging
 logging.basicConfig(
@@ -21,6 +25,7 @@ logging.basicConfig(
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+logger.debug("BOT_TOKEN loaded: %s", bool(BOT_TOKEN))
 
 # Global queue manager
 queue_manager: QueueManager = None
@@ -35,7 +40,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• Auto sample generation (10-30 sec)\n"
         "• Centered watermark\n"
         "• Live progress updates\n"
-        "• Unlimited queue support\n\n"
+        "• Queue support\n\n"
         "**Commands:**\n"
         "/start - Show this message\n"
         "/queue - Check queue status\n"
@@ -66,10 +71,13 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def queue_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /queue command"""
     queue_size = queue_manager.get_queue_size()
-    is_processing = queue_manager.is_processing
+    active_count = queue_manager.get_active_count()
     
-    if is_processing:
-        status = f"🔄 **Currently processing a video**\n📋 Videos in queue: {queue_size}"
+    if active_count:
+        status = (
+            f"🔄 **Currently processing {active_count} video(s)**\n"
+            f"📋 Videos in queue: {queue_size}"
+        )
     elif queue_size > 0:
         status = f"📋 Videos in queue: {queue_size}"
     else:
@@ -104,41 +112,49 @@ async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Check file size (optional, Telegram already limits this)
     file_size_mb = video.file_size / (1024 * 1024) if video.file_size else 0
-    logger.info(f"Received video from user {user_id}: {filename} ({file_size_mb:.2f} MB)")
+    logger.info("Received video from user %s: %s (%.2f MB)", user_id, filename, file_size_mb)
     
-    # Send initial status
-    status_msg = await update.message.reply_text("📥 Downloading video...")
+    # Reject early when there is no room in the queue
+    if queue_manager.get_queue_size() >= MAX_QUEUE_SIZE:
+        await update.message.reply_text("⏳ Queue is full. Please try again later.")
+        return
+    
+    # Input plus output must fit in temp storage
+    if not queue_manager.has_temp_space(video.file_size or 0):
+        await update.message.reply_text("⏳ Not enough storage right now. Please try again later.")
+        return
+    
+    # Send initial status before queuing so the worker's edits can't be overwritten
+    if queue_manager.has_free_slot():
+        status_msg = await update.message.reply_text("🎬 Processing your video...")
+    else:
+        position = queue_manager.get_queue_size() + 1
+        status_msg = await update.message.reply_text(
+            f"🎬 Video added to queue | Position: #{position}"
+        )
     
     try:
-        # Download file
-        file = await context.bot.get_file(video.file_id)
-        input_path = TEMP_DIR / f"{user_id}_{message_id}.input"
-        output_path = TEMP_DIR / f"{user_id}_{message_id}.output.mp4"
-        
-        await file.download_to_drive(input_path)
-        logger.info(f"Downloaded to: {input_path}")
-        
-        # Create job
+        # Create job; the worker downloads the file when its turn comes
         job = VideoJob(
             user_id=user_id,
             chat_id=chat_id,
             message_id=message_id,
-            input_path=input_path,
-            output_path=output_path,
-            status_message_id=status_msg.message_id
+            file_id=video.file_id,
+            input_path=TEMP_DIR / f"{user_id}_{message_id}.input",
+            output_path=TEMP_DIR / f"{user_id}_{message_id}.output.mp4",
+            status_message_id=status_msg.message_id,
+            file_size=video.file_size or 0
         )
         
         # Add to queue
-        position = await queue_manager.add_job(job)
-        
-        if position == 1 and not queue_manager.is_processing:
-            await status_msg.edit_text("🎬 Processing your video...")
-        else:
-            await status_msg.edit_text(f"🎬 Video added to queue | Position: #{position}")
+        await queue_manager.add_job(job)
+    
+    except QueueFullError:
+        await status_msg.edit_text("⏳ Queue is full. Please try again later.")
     
     except Exception as e:
-        logger.error(f"Error handling video: {e}", exc_info=True)
-        await status_msg.edit_text(f"❌ Download failed: {str(e)[:100]}")
+        logger.error("Error handling video: %s", e, exc_info=True)
+        await status_msg.edit_text(f"❌ Failed to queue video: {str(e)[:100]}")
 
 
 async def handle_unsupported(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -149,14 +165,27 @@ async def handle_unsupported(update: Update, context: ContextTypes.DEFAULT_TYPE)
     )
 
 
+async def periodic_cleanup():
+    """Periodically delete temp files orphaned by failed jobs"""
+    while True:
+        await asyncio.sleep(TEMP_CLEANUP_INTERVAL)
+        await cleanup_temp_files(
+            max_age_seconds=TEMP_FILE_MAX_AGE,
+            exclude=queue_manager.get_live_paths()
+        )
+
+
 async def post_init(application: Application):
     """Initialize after app is set up"""
     global queue_manager
     
     logger.info("Starting bot initialization...")
     
-    # Clean temp directory
-    await cleanup_temp_files()
+    # Clean temp directory (no jobs exist yet, so everything is stale)
+    await cleanup_temp_files(max_age_seconds=0)
+    
+    # Pick hardware encoder if one is usable
+    await detect_hw_encoder()
     
     # Initialize queue manager
     queue_manager = QueueManager(application.bot)
@@ -164,6 +193,9 @@ async def post_init(application: Application):
     # Start queue worker
     asyncio.create_task(queue_manager.start_worker())
     
+    # Start stale temp file sweeper
+    asyncio.create_task(periodic_cleanup())
+    
     logger.info("Bot initialized successfully!")
 
 
@@ -171,6 +203,9 @@ def main():
     """Start the bot"""
     logger.info("Starting Video Sample Generator Bot...")
     
+    # Use libuv-based event loop for faster subprocess and socket I/O
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    
     # Create application
     application = (
         Application.builder()
@@ -3,18 +3,23 @@ from pathlib import Path
 
 # Bot Configuration
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-print(f"DEBUG: BOT_TOKEN value: {BOT_TOKEN[:10] if BOT_TOKEN else 'NOT FOUND'}...")
-print(f"DEBUG: All env vars: {list(os.environ.keys())}")
 
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN environment variable is required")
 
-# File Paths
-TEMP_DIR = Path("./temp")
-TEMP_DIR.mkdir(exist_ok=True)
+# File Paths (RAM-backed /dev/shm when available to avoid disk round-trips)
+TEMP_DIR = Path(
+    os.getenv("TEMP_DIR")
+    or ("/dev/shm/video-bot" if Path("/dev/shm").is_dir() else "./temp")
+)
+TEMP_DIR.mkdir(parents=True, exist_ok=True)
+TEMP_DIR_MAX_BYTES = int(os.getenv("TEMP_DIR_MAX_BYTES", "0"))  # 0 = only limited by free space
+TEMP_CLEANUP_INTERVAL = 600  # Seconds between stale temp file sweeps
+TEMP_FILE_MAX_AGE = 1800     # Orphaned temp files older than this are deleted
 
 # Watermark Configuration
-WATERMARK_TEXT = "Search ON TG @Linkz_Wallah"
+WATERMARK_ENABLED = True  # False = stream-copy the sample (re-encoded if codecs don't fit MP4)
+WATERMARK_TEXT = "Search ON TG @Linkz_Wallah"  # Colons are escaped; avoid ' and \
 WATERMARK_OPACITY = 0.6
 
 # Sample Duration Rules (in seconds)
@@ -22,12 +27,24 @@ LONG_VIDEO_THRESHOLD = 120  # Videos longer than this
 LONG_VIDEO_SAMPLE = 30      # Get 30 sec sample
 SHORT_VIDEO_SAMPLE = 10     # Otherwise 10 sec
 
+# Queue Settings
+CPU_COUNT = os.cpu_count() or 2
+MAX_QUEUE_SIZE = 50  # Jobs waiting beyond this are rejected
+MAX_CONCURRENT_JOBS = max(1, CPU_COUNT // 2)  # Parallel FFmpeg jobs
+
 # FFmpeg Settings
 FFMPEG_PRESET = "veryfast"
 FFMPEG_CRF = 23  # Quality (lower = better, 18-28 recommended)
+FFMPEG_THREADS = max(1, CPU_COUNT // MAX_CONCURRENT_JOBS)  # Threads per job (jobs x threads ~ cores)
+SEEK_PREROLL = 5  # Seconds decoded before the sample start for accurate seeking
+HW_ACCEL = "auto"  # Hardware encoder: auto, nvenc, vaapi or none (libx264)
+VAAPI_DEVICE = "/dev/dri/renderD128"
+HW_PROBE_TIMEOUT = 15  # Seconds allowed per startup encoder check
 
 # Telegram Settings
 MAX_EDIT_INTERVAL = 1.0  # Minimum seconds between message edits
+MAX_EDITS_PER_SECOND = 25  # Global edit budget (Telegram allows ~30 req/s)
+MAX_TRACKED_MESSAGES = 4096  # Status messages remembered for edit rate limiting
 
 # Supported Formats
-SUPPORTED_FORMATS = [".mp4", ".mkv", ".webm", ".avi", ".mov", ".flv", ".m4v"]
+SUPPORTED_FORMATS = frozenset({".mp4", ".mkv", ".webm", ".avi", ".mov", ".flv", ".m4v"})
@@ -1,14 +1,20 @@
 import asyncio
 import logging
+import shutil
 import time
+from collections import OrderedDict
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional, Set, FrozenSet
 from dataclasses import dataclass
 
+import aiofiles
 from telegram import Bot
-from telegram.error import TelegramError
+from telegram.error import RetryAfter, TelegramError
 
-from config import TEMP_DIR, MAX_EDIT_INTERVAL
+from config import (
+    TEMP_DIR, TEMP_DIR_MAX_BYTES, MAX_EDIT_INTERVAL, MAX_EDITS_PER_SECOND,
+    MAX_TRACKED_MESSAGES, MAX_CONCURRENT_JOBS, MAX_QUEUE_SIZE, WATERMARK_ENABLED
+)
 from utils import (
     get_video_info,
     calculate_sample_params,
@@ -20,58 +26,120 @@ from utils import (
 logger = logging.getLogger(__name__)
 
 
-@dataclass
+class QueueFullError(Exception):
+    """Raised when a job is submitted to a full queue"""
+
+
+@dataclass(slots=True, frozen=True)
 class VideoJob:
     """Represents a video processing job"""
     user_id: int
     chat_id: int
     message_id: int
+    file_id: str
     input_path: Path
     output_path: Path
     status_message_id: Optional[int] = None
+    file_size: int = 0
 
 
 class QueueManager:
     def __init__(self, bot: Bot):
         self.bot = bot
-        self.queue = asyncio.Queue()
-        self.is_processing = False
-        self.current_job: Optional[VideoJob] = None
+        self.queue = asyncio.Queue(maxsize=MAX_QUEUE_SIZE)
         self.queue_counter = 0
-        self.last_edit_time = {}
+        self.last_edit_time: OrderedDict[int, float] = OrderedDict()
+        self._sem = asyncio.Semaphore(MAX_CONCURRENT_JOBS)
+        self._active: Set[asyncio.Task] = set()
+        self._live_paths: Set[Path] = set()
+        self._reserved_bytes = 0
+        self._unwritten_bytes: Dict[Path, int] = {}
+        self._edit_tokens = asyncio.Semaphore(MAX_EDITS_PER_SECOND)
+        self._global_retry_until = 0.0
+        self._deferred_edits: Set[asyncio.Task] = set()
+    
+    @property
+    def is_processing(self) -> bool:
+        """Whether any job is currently being processed"""
+        return len(self._active) > 0
     
     async def add_job(self, job: VideoJob) -> int:
         """Add job to queue and return position"""
-        await self.queue.put(job)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise QueueFullError(f"Queue is full ({MAX_QUEUE_SIZE} jobs)")
+        self._live_paths.update((job.input_path, job.output_path))
+        self._reserved_bytes += job.file_size * 2
+        self._unwritten_bytes[job.input_path] = job.file_size * 2
         self.queue_counter += 1
         position = self.queue.qsize()
-        logger.info(f"Job added to queue. Position: {position}")
+        logger.info("Job added to queue. Position: %s", position)
         return position
     
     def get_queue_size(self) -> int:
         """Get current queue size"""
         return self.queue.qsize()
     
+    def has_temp_space(self, file_size: int) -> bool:
+        """Check whether temp storage can hold another job's input and output"""
+        needed = file_size * 2
+        if TEMP_DIR_MAX_BYTES and self._reserved_bytes + needed > TEMP_DIR_MAX_BYTES:
+            return False
+        # Free space doesn't yet reflect files other jobs will still write
+        unwritten = sum(self._unwritten_bytes.values())
+        return shutil.disk_usage(TEMP_DIR).free - unwritten >= needed
+    
+    def _mark_written(self, job: VideoJob, nbytes: int):
+        """Drop bytes of a job's reservation that are now on disk"""
+        remaining = self._unwritten_bytes.get(job.input_path)
+        if remaining is not None:
+            self._unwritten_bytes[job.input_path] = max(0, remaining - nbytes)
+    
+    def get_live_paths(self) -> FrozenSet[Path]:
+        """Get temp file paths owned by queued or running jobs"""
+        return frozenset(self._live_paths)
+    
+    def has_free_slot(self) -> bool:
+        """Whether a newly added job would start processing immediately"""
+        return len(self._active) < MAX_CONCURRENT_JOBS and self.queue.qsize() == 0
+    
+    def get_active_count(self) -> int:
+        """Get number of jobs currently being processed"""
+        return len(self._active)
+    
     async def start_worker(self):
         """Start the queue worker task"""
-        logger.info("Starting queue worker")
+        logger.info("Starting queue worker (%s concurrent jobs)", MAX_CONCURRENT_JOBS)
         while True:
             try:
+                # Wait for a free slot first so pending jobs stay counted in the queue
+                await self._sem.acquire()
                 job = await self.queue.get()
-                self.current_job = job
-                self.is_processing = True
-                
-                await self._process_job(job)
                 
-                self.queue.task_done()
-                self.current_job = None
-                self.is_processing = False
+                task = asyncio.create_task(self._process_job(job))
+                self._active.add(task)
+                task.add_done_callback(self._on_job_done)
                 
             except Exception as e:
-                logger.error(f"Worker error: {e}", exc_info=True)
-                self.is_processing = False
+                logger.error("Worker error: %s", e, exc_info=True)
     
-    async def _update_status(self, job: VideoJob, text: str, force: bool = False):
+    def _on_job_done(self, task: asyncio.Task):
+        """Release the job slot once a job task finishes"""
+        self._active.discard(task)
+        self._sem.release()
+        self.queue.task_done()
+        
+        if not task.cancelled() and task.exception():
+            logger.error("Job task failed", exc_info=task.exception())
+    
+    async def _update_status(
+        self,
+        job: VideoJob,
+        text: str,
+        force: bool = False,
+        final: bool = False
+    ):
         """Update status message with rate limiting"""
         try:
             if not job.status_message_id:
@@ -81,23 +149,106 @@ class QueueManager:
             last_time = self.last_edit_time.get(job.status_message_id, 0)
             
             if force or (current_time - last_time) >= MAX_EDIT_INTERVAL:
-                await self.bot.edit_message_text(
-                    chat_id=job.chat_id,
-                    message_id=job.status_message_id,
-                    text=text
-                )
-                self.last_edit_time[job.status_message_id] = current_time
+                if await self._edit_message(job, text, final):
+                    self._record_edit(job.status_message_id, current_time)
                 
         except TelegramError as e:
             if "message is not modified" not in str(e).lower():
-                logger.warning(f"Failed to update status: {e}")
+                logger.warning("Failed to update status: %s", e)
+    
+    def _record_edit(self, message_id: int, edit_time: float):
+        """Remember last edit time, evicting the oldest entries past the cap"""
+        self.last_edit_time[message_id] = edit_time
+        self.last_edit_time.move_to_end(message_id)
+        while len(self.last_edit_time) > MAX_TRACKED_MESSAGES:
+            self.last_edit_time.popitem(last=False)
+    
+    async def _edit_message(self, job: VideoJob, text: str, final: bool = False) -> bool:
+        """
+        Edit status message within the global Telegram rate limit
+        Edits are dropped while Telegram has told us to back off; final
+        messages are instead re-sent in the background once the window ends
+        """
+        if time.monotonic() < self._global_retry_until:
+            if final:
+                self._defer_edit(job, text)
+            return False
+        
+        try:
+            await self._send_edit(job, text)
+            return True
+        except RetryAfter as e:
+            self._on_retry_after(e)
+            if final:
+                self._defer_edit(job, text)
+            return False
+    
+    async def _send_edit(self, job: VideoJob, text: str):
+        """Send one edit, spending a rate limit token"""
+        # Each token is returned ~1s after use, capping edits per second
+        await self._edit_tokens.acquire()
+        asyncio.get_running_loop().call_later(1.1, self._edit_tokens.release)
+        
+        await self.bot.edit_message_text(
+            chat_id=job.chat_id,
+            message_id=job.status_message_id,
+            text=text
+        )
+    
+    def _on_retry_after(self, e: RetryAfter):
+        """Pause all edits for the window Telegram asked for"""
+        self._global_retry_until = time.monotonic() + e.retry_after
+        logger.warning("Rate limited by Telegram, pausing edits for %ss", e.retry_after)
+    
+    def _defer_edit(self, job: VideoJob, text: str):
+        """Deliver a final status edit after the retry window without blocking the job"""
+        task = asyncio.create_task(self._send_after_retry(job, text))
+        self._deferred_edits.add(task)
+        task.add_done_callback(self._deferred_edits.discard)
+    
+    async def _send_after_retry(self, job: VideoJob, text: str):
+        """Wait out the retry window, then send the edit"""
+        while True:
+            wait = self._global_retry_until - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            
+            try:
+                await self._send_edit(job, text)
+                return
+            except RetryAfter as e:
+                self._on_retry_after(e)
+            except TelegramError as e:
+                if "message is not modified" not in str(e).lower():
+                    logger.warning("Failed to send deferred status: %s", e)
+                return
     
     async def _process_job(self, job: VideoJob):
         """Process a single video job"""
-        logger.info(f"Processing job for user {job.user_id}")
+        logger.info("Processing job for user %s", job.user_id)
         
         try:
-            # Stage 1: Analyze video
+            # Stage 1: Download video
+            await self._update_status(job, "📥 Downloading video...", force=True)
+            
+            try:
+                file = await self.bot.get_file(job.file_id)
+                await file.download_to_drive(job.input_path)
+            except TelegramError as e:
+                logger.error("Download failed: %s", e)
+                await self._update_status(
+                    job,
+                    f"❌ Download failed: {str(e)[:100]}",
+                    force=True,
+                    final=True
+                )
+                return
+            
+            logger.info("Downloaded to: %s", job.input_path)
+            self._mark_written(job, job.file_size)
+            
+            # Stage 2: Analyze video
             await self._update_status(job, "📏 Analyzing video...", force=True)
             
             video_info = await get_video_info(job.input_path)
@@ -106,27 +257,27 @@ class QueueManager:
                 await self._update_status(
                     job,
                     "❌ Failed to analyze video. File may be corrupted.",
-                    force=True
+                    force=True,
+                    final=True
                 )
-                self._cleanup_job(job)
                 return
             
-            duration = video_info["duration"]
-            width = video_info["width"]
-            height = video_info["height"]
+            duration = video_info.duration
+            width = video_info.width
+            height = video_info.height
             
             if duration <= 0:
                 await self._update_status(
                     job,
                     "❌ Invalid video duration detected.",
-                    force=True
+                    force=True,
+                    final=True
                 )
-                self._cleanup_job(job)
                 return
             
-            logger.info(f"Video info: {duration}s, {width}x{height}")
+            logger.info("Video info: %ss, %sx%s", duration, width, height)
             
-            # Stage 2: Calculate sample parameters
+            # Stage 3: Calculate sample parameters
             start_time, sample_duration = calculate_sample_params(duration)
             
             await self._update_status(
@@ -135,7 +286,7 @@ class QueueManager:
                 force=True
             )
             
-            # Stage 3: Create sample with progress tracking
+            # Stage 4: Create sample with progress tracking
             async def progress_callback(progress: float):
                 bar = format_progress_bar(progress)
                 await self._update_status(
@@ -150,28 +301,40 @@ class QueueManager:
                 sample_duration,
                 width,
                 height,
-                progress_callback
+                progress_callback,
+                video_codec=video_info.video_codec,
+                audio_codec=video_info.audio_codec
             )
             
             if not success:
                 await self._update_status(
                     job,
                     "❌ Failed to create sample. FFmpeg error.",
-                    force=True
+                    force=True,
+                    final=True
                 )
-                self._cleanup_job(job)
                 return
             
-            # Stage 4: Upload result
+            self._mark_written(job, job.file_size)
+            
+            # Stage 5: Upload result
             await self._update_status(job, "📤 Uploading sample...", force=True)
             
-            with open(job.output_path, "rb") as video_file:
-                await self.bot.send_video(
-                    chat_id=job.chat_id,
-                    video=video_file,
-                    caption="✅ Sample Ready | Watermarked Preview",
-                    supports_streaming=True
-                )
+            # PTB reads the whole file into memory anyway; do it off the loop
+            async with aiofiles.open(job.output_path, "rb") as video_file:
+                video_data = await video_file.read()
+            
+            await self.bot.send_video(
+                chat_id=job.chat_id,
+                video=video_data,
+                filename=job.output_path.name,
+                caption=(
+                    "✅ Sample Ready | Watermarked Preview"
+                    if WATERMARK_ENABLED
+                    else "✅ Sample Ready | Preview"
+                ),
+                supports_streaming=True
+            )
             
             # Delete status message
             try:
@@ -182,21 +345,28 @@ class QueueManager:
             except:
                 pass
             
-            logger.info(f"Job completed for user {job.user_id}")
+            logger.info("Job completed for user %s", job.user_id)
         
         except Exception as e:
-            logger.error(f"Job processing error: {e}", exc_info=True)
+            logger.error("Job processing error: %s", e, exc_info=True)
             await self._update_status(
                 job,
                 f"❌ Processing failed: {str(e)[:100]}",
-                force=True
+                force=True,
+                final=True
             )
         
         finally:
-            self._cleanup_job(job)
+            await self._cleanup_job(job)
     
-    def _cleanup_job(self, job: VideoJob):
+    async def _cleanup_job(self, job: VideoJob):
         """Clean up job files"""
-        logger.info(f"Cleaning up job files for user {job.user_id}")
-        delete_file(job.input_path)
-        delete_file(job.output_path)
+        logger.info("Cleaning up job files for user %s", job.user_id)
+        self.last_edit_time.pop(job.status_message_id, None)
+        await asyncio.gather(
+            asyncio.to_thread(delete_file, job.input_path),
+            asyncio.to_thread(delete_file, job.output_path)
+        )
+        self._live_paths.difference_update((job.input_path, job.output_path))
+        self._reserved_bytes -= job.file_size * 2
+        self._unwritten_bytes.pop(job.input_path, None)
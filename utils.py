@@ -1,33 +1,122 @@
 import asyncio
+import bisect
+import functools
 import json
-import re
+import os
 import shutil
+import time
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional, Tuple, Callable
+from typing import Optional, Tuple, Callable, FrozenSet
 import logging
 
 from config import (
-    TEMP_DIR, WATERMARK_TEXT, WATERMARK_OPACITY,
-    FFMPEG_PRESET, FFMPEG_CRF, SUPPORTED_FORMATS
+    TEMP_DIR, WATERMARK_ENABLED, WATERMARK_TEXT, WATERMARK_OPACITY,
+    FFMPEG_PRESET, FFMPEG_CRF, FFMPEG_THREADS, SEEK_PREROLL,
+    HW_ACCEL, HW_PROBE_TIMEOUT, VAAPI_DEVICE, SUPPORTED_FORMATS
 )
 
 logger = logging.getLogger(__name__)
 
+# Progress timestamp line FFmpeg writes with -progress (microseconds)
+_OUT_TIME_PREFIX = b"out_time_us="
+_OUT_TIME_LEN = len(_OUT_TIME_PREFIX)
 
-async def cleanup_temp_files():
-    """Clean all files in temp directory"""
+# Watermark text escaped once for FFmpeg drawtext (only ":" is handled,
+# see WATERMARK_TEXT in config.py)
+_WATERMARK_TEXT_ESCAPED = WATERMARK_TEXT.replace(":", r"\:")
+
+# Bitrate tiers as (max pixel count, bitrate), ascending
+_BITRATE_TABLE = [
+    (640 * 480, "500k"),      # 480p or lower
+    (1280 * 720, "1000k"),    # 720p
+    (1920 * 1080, "2000k"),   # 1080p
+    (3840 * 2160, "4000k"),   # 4K
+    (float("inf"), "8000k")   # Above 4K
+]
+_BITRATE_PIXELS = [pixels for pixels, _ in _BITRATE_TABLE]
+
+# Hardware H.264 encoder in use ("nvenc", "vaapi"), None for libx264
+_hw_encoder: Optional[str] = None
+
+# Static FFmpeg argv pieces; only times, paths, filter and bitrate vary per job
+_FFMPEG_PREFIX = ("ffmpeg", "-y")  # Overwrite output
+_FFMPEG_SUFFIX = (
+    "-movflags", "+faststart",
+    "-stats_period", "1",
+    "-progress", "pipe:1",
+    "-nostats",
+    "-loglevel", "error"
+)
+_COPY_ARGS = ("-c", "copy", "-avoid_negative_ts", "make_zero")
+
+# Use exactly the streams get_video_info probed: the first video stream that
+# isn't cover art ("V") and the first audio stream, with no subtitles or data
+_MAP_ARGS = ("-map", "0:V:0", "-map", "0:a:0?", "-sn", "-dn")
+
+# Codecs the MP4 muxer accepts as-is; anything else must be re-encoded
+_MP4_VIDEO_CODECS = frozenset({"h264", "hevc", "mpeg4", "av1"})
+_MP4_AUDIO_CODECS = frozenset({"aac", "mp3", "ac3", "eac3", "alac"})
+_AUDIO_COPY_ARGS = ("-c:a", "copy")
+_AUDIO_ENCODE_ARGS = ("-c:a", "aac", "-b:a", "128k")
+
+# Cap decoder, filter and encoder threads so concurrent jobs
+# don't each spawn one thread per core
+_THREAD_ARGS = ("-threads", str(FFMPEG_THREADS))
+_FILTER_THREAD_ARGS = ("-filter_threads", str(FFMPEG_THREADS))
+
+# Hardware decodes/encodes, drawtext still runs on CPU frames
+_HW_INPUT_ARGS = {
+    "nvenc": ("-hwaccel", "cuda"),
+    "vaapi": ("-vaapi_device", VAAPI_DEVICE, "-hwaccel", "vaapi")
+}
+_HW_UPLOAD_FILTERS = {"vaapi": ("format=nv12", "hwupload")}
+_VIDEO_ENCODE_ARGS = {
+    None: ("-c:v", "libx264", "-preset", FFMPEG_PRESET, "-crf", str(FFMPEG_CRF)),
+    "nvenc": ("-c:v", "h264_nvenc", "-preset", "p4", "-cq", str(FFMPEG_CRF)),
+    "vaapi": ("-c:v", "h264_vaapi", "-qp", str(FFMPEG_CRF))
+}
+
+
+@dataclass(slots=True)
+class VideoInfo:
+    """Probed properties of an input video"""
+    duration: float
+    width: int
+    height: int
+    video_codec: Optional[str] = None
+    audio_codec: Optional[str] = None
+
+
+def _sync_cleanup(max_age_seconds: float, exclude: FrozenSet[Path]):
+    """Delete stale files in temp directory (blocking)"""
+    if not TEMP_DIR.exists():
+        return
+    
+    cutoff = time.time() - max_age_seconds
+    with os.scandir(TEMP_DIR) as entries:
+        for entry in entries:
+            try:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                if Path(entry.path) in exclude or entry.stat().st_mtime >= cutoff:
+                    continue
+                os.unlink(entry.path)
+                logger.info("Deleted: %s", entry.path)
+            except Exception as e:
+                logger.error("Failed to delete %s: %s", entry.path, e)
+
+
+async def cleanup_temp_files(
+    max_age_seconds: float = 3600,
+    exclude: FrozenSet[Path] = frozenset()
+):
+    """Delete temp files older than max_age_seconds, skipping excluded paths"""
     try:
-        if TEMP_DIR.exists():
-            for file in TEMP_DIR.iterdir():
-                try:
-                    if file.is_file():
-                        file.unlink()
-                        logger.info(f"Deleted: {file}")
-                except Exception as e:
-                    logger.error(f"Failed to delete {file}: {e}")
+        await asyncio.to_thread(_sync_cleanup, max_age_seconds, exclude)
         logger.info("Temp directory cleaned")
     except Exception as e:
-        logger.error(f"Cleanup error: {e}")
+        logger.error("Cleanup error: %s", e)
 
 
 def delete_file(file_path: Path):
@@ -35,18 +124,19 @@ def delete_file(file_path: Path):
     try:
         if file_path and file_path.exists():
             file_path.unlink()
-            logger.info(f"Deleted: {file_path}")
+            logger.info("Deleted: %s", file_path)
     except Exception as e:
-        logger.error(f"Failed to delete {file_path}: {e}")
+        logger.error("Failed to delete %s: %s", file_path, e)
 
 
-async def get_video_info(file_path: Path) -> Optional[dict]:
-    """Get video duration and resolution using ffprobe"""
+async def get_video_info(file_path: Path) -> Optional[VideoInfo]:
+    """Get video duration, resolution and codecs using ffprobe"""
     try:
         cmd = [
             "ffprobe",
             "-v", "error",
-            "-show_entries", "format=duration:stream=width,height",
+            "-show_entries", "stream=codec_type,codec_name,width,height"
+            ":stream_disposition=attached_pic:format=duration",
             "-of", "json",
             str(file_path)
         ]
@@ -60,29 +150,37 @@ async def get_video_info(file_path: Path) -> Optional[dict]:
         stdout, stderr = await proc.communicate()
         
         if proc.returncode != 0:
-            logger.error(f"FFprobe error: {stderr.decode()}")
+            logger.error("FFprobe error: %s", stderr.decode())
             return None
         
-        data = json.loads(stdout.decode())
+        data = json.loads(stdout)
         
         duration = float(data.get("format", {}).get("duration", 0))
         streams = data.get("streams", [])
         
         width = height = 0
+        video_codec = audio_codec = None
         for stream in streams:
-            if "width" in stream:
+            codec_type = stream.get("codec_type")
+            if stream.get("disposition", {}).get("attached_pic"):
+                continue  # Cover art, not the video track
+            if codec_type == "video" and video_codec is None and "width" in stream:
                 width = stream["width"]
                 height = stream["height"]
-                break
+                video_codec = stream.get("codec_name")
+            elif codec_type == "audio" and audio_codec is None:
+                audio_codec = stream.get("codec_name")
         
-        return {
-            "duration": duration,
-            "width": width,
-            "height": height
-        }
+        return VideoInfo(
+            duration=duration,
+            width=width,
+            height=height,
+            video_codec=video_codec,
+            audio_codec=audio_codec
+        )
     
     except Exception as e:
-        logger.error(f"Failed to get video info: {e}")
+        logger.error("Failed to get video info: %s", e)
         return None
 
 
@@ -103,28 +201,84 @@ def calculate_sample_params(duration: float) -> Tuple[float, float]:
 
 def get_bitrate_for_resolution(width: int, height: int) -> str:
     """Determine appropriate bitrate based on resolution"""
-    pixels = width * height
+    return _BITRATE_TABLE[bisect.bisect_left(_BITRATE_PIXELS, width * height)][1]
+
+
+async def _run_ffmpeg_check(*args: str) -> Optional[bytes]:
+    """
+    Run a short FFmpeg command and return its stdout if it exited cleanly
+    Returns None on failure or after HW_PROBE_TIMEOUT, killing a hung process
+    """
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-hide_banner", "-loglevel", "error", *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+    except Exception as e:
+        logger.error("FFmpeg check failed: %s", e)
+        return None
+    
+    try:
+        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=HW_PROBE_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("FFmpeg check timed out: %s", args)
+        proc.kill()
+        await proc.wait()
+        return None
     
-    if pixels <= 640 * 480:  # 480p or lower
-        return "500k"
-    elif pixels <= 1280 * 720:  # 720p
-        return "1000k"
-    elif pixels <= 1920 * 1080:  # 1080p
-        return "2000k"
-    else:  # 4K+
-        return "4000k"
+    return stdout if proc.returncode == 0 else None
 
 
+async def detect_hw_encoder() -> Optional[str]:
+    """
+    Pick a working hardware H.264 encoder according to HW_ACCEL
+    Each candidate must be listed by FFmpeg and pass a tiny test encode,
+    since builds often ship encoders the host has no device for
+    """
+    global _hw_encoder
+    _hw_encoder = None
+    
+    if HW_ACCEL == "none":
+        return None
+    
+    encoders = await _run_ffmpeg_check("-encoders")
+    if encoders is None:
+        logger.error("Failed to list FFmpeg encoders, using libx264")
+        return None
+    
+    test_input = ["-f", "lavfi", "-i", "color=black:size=256x256:duration=0.1"]
+    candidates = {
+        "nvenc": [*test_input, "-c:v", "h264_nvenc", "-f", "null", "-"],
+        "vaapi": [
+            "-vaapi_device", VAAPI_DEVICE, *test_input,
+            "-vf", "format=nv12,hwupload", "-c:v", "h264_vaapi", "-f", "null", "-"
+        ]
+    }
+    
+    for name, test_args in candidates.items():
+        if HW_ACCEL not in ("auto", name):
+            continue
+        if f"h264_{name}".encode() not in encoders:
+            continue
+        if name == "vaapi" and not Path(VAAPI_DEVICE).exists():
+            continue
+        if await _run_ffmpeg_check(*test_args) is not None:
+            _hw_encoder = name
+            break
+    
+    logger.info("Video encoder: %s", f"h264_{_hw_encoder}" if _hw_encoder else "libx264")
+    return _hw_encoder
+
+
+@functools.lru_cache(maxsize=64)
 def build_watermark_filter(width: int, height: int) -> str:
     """Build FFmpeg drawtext filter for centered watermark"""
     # Auto-scale font size based on resolution
     font_size = int(min(width, height) * 0.04)  # 4% of smaller dimension
     
-    # Escape text for FFmpeg
-    text = WATERMARK_TEXT.replace(":", r"\:")
-    
     return (
-        f"drawtext=text='{text}':"
+        f"drawtext=text='{_WATERMARK_TEXT_ESCAPED}':"
         f"fontsize={font_size}:"
         f"fontcolor=white@{WATERMARK_OPACITY}:"
         f"borderw=2:"
@@ -134,43 +288,63 @@ def build_watermark_filter(width: int, height: int) -> str:
     )
 
 
-async def create_sample_video(
+def _build_encode_cmd(
     input_path: Path,
     output_path: Path,
     start_time: float,
     duration: float,
     width: int,
     height: int,
+    audio_codec: Optional[str],
+    encoder: Optional[str]
+) -> list:
+    """Build the re-encode FFmpeg command for the given encoder (None = libx264)"""
+    bitrate = get_bitrate_for_resolution(width, height)
+    video_filters = [
+        *((build_watermark_filter(width, height),) if WATERMARK_ENABLED else ()),
+        *_HW_UPLOAD_FILTERS.get(encoder, ())
+    ]
+    filter_args = ("-vf", ",".join(video_filters)) if video_filters else ()
+    
+    # AAC audio is already MP4-compatible, so skip re-encoding it
+    audio_args = _AUDIO_COPY_ARGS if audio_codec == "aac" else _AUDIO_ENCODE_ARGS
+    
+    # VAAPI runs in constant-QP mode, which a bitrate would override
+    bitrate_args = () if encoder == "vaapi" else ("-b:v", bitrate)
+    
+    # Fast keyframe seek to just before the sample, then an accurate
+    # seek in the decoded stream so sparse indexes can't force a full decode
+    preroll = min(SEEK_PREROLL, start_time)
+    
+    return [
+        *_FFMPEG_PREFIX,
+        *_FILTER_THREAD_ARGS,
+        *_HW_INPUT_ARGS.get(encoder, ()),
+        *_THREAD_ARGS,
+        "-ss", f"{start_time - preroll:.3f}",
+        "-i", str(input_path),
+        "-ss", f"{preroll:.3f}",
+        "-t", f"{duration:.3f}",
+        *_MAP_ARGS,
+        *filter_args,
+        *_VIDEO_ENCODE_ARGS[encoder],
+        *bitrate_args,
+        *_THREAD_ARGS,
+        *audio_args,
+        *_FFMPEG_SUFFIX,
+        str(output_path)
+    ]
+
+
+async def _run_ffmpeg(
+    cmd: list,
+    output_path: Path,
+    duration: float,
     progress_callback: Optional[Callable[[float], None]] = None
 ) -> bool:
-    """
-    Create sample video with watermark using FFmpeg
-    Returns True on success, False on failure
-    """
+    """Run an FFmpeg command, reporting progress; True on success"""
     try:
-        bitrate = get_bitrate_for_resolution(width, height)
-        watermark_filter = build_watermark_filter(width, height)
-        
-        cmd = [
-            "ffmpeg",
-            "-y",  # Overwrite output
-            "-ss", str(start_time),
-            "-i", str(input_path),
-            "-t", str(duration),
-            "-vf", watermark_filter,
-            "-c:v", "libx264",
-            "-preset", FFMPEG_PRESET,
-            "-crf", str(FFMPEG_CRF),
-            "-b:v", bitrate,
-            "-c:a", "aac",
-            "-b:a", "128k",
-            "-movflags", "+faststart",
-            "-progress", "pipe:1",
-            "-loglevel", "error",
-            str(output_path)
-        ]
-        
-        logger.info(f"Starting FFmpeg: {' '.join(cmd)}")
+        logger.debug("Starting FFmpeg: %s", cmd)
         
         proc = await asyncio.create_subprocess_exec(
             *cmd,
@@ -180,24 +354,34 @@ async def create_sample_video(
         
         # Monitor progress
         last_progress = 0.0
+        buffer = bytearray()
         while True:
-            line = await proc.stdout.readline()
-            if not line:
+            chunk = await proc.stdout.read(4096)
+            if not chunk:
                 break
             
-            line_str = line.decode().strip()
+            buffer += chunk
+            *lines, remainder = buffer.split(b"\n")
+            buffer = bytearray(remainder)
             
-            # Parse out_time_ms for progress
-            if "out_time_ms=" in line_str:
-                match = re.search(r"out_time_ms=(\d+)", line_str)
-                if match:
-                    time_ms = int(match.group(1))
-                    time_sec = time_ms / 1_000_000
-                    progress = min(time_sec / duration, 1.0)
-                    
-                    if progress_callback and progress - last_progress >= 0.05:
-                        await progress_callback(progress)
-                        last_progress = progress
+            # Parse out_time_us for progress
+            for line in lines:
+                if not line.startswith(_OUT_TIME_PREFIX):
+                    continue
+                try:
+                    time_us = int(line[_OUT_TIME_LEN:])
+                except ValueError:
+                    continue  # "N/A" before the first frame is written
+                
+                time_sec = time_us / 1_000_000
+                progress = min(time_sec / duration, 1.0)
+                
+                if progress_callback and progress - last_progress >= 0.05:
+                    await progress_callback(progress)
+                    last_progress = progress
+            
+            # Always yield to the loop, even when data was already buffered
+            await asyncio.sleep(0)
         
         await proc.wait()
         
@@ -206,14 +390,72 @@ async def create_sample_video(
             return True
         else:
             stderr = await proc.stderr.read()
-            logger.error(f"FFmpeg failed: {stderr.decode()}")
+            logger.error("FFmpeg failed: %s", stderr.decode())
             return False
     
     except Exception as e:
-        logger.error(f"FFmpeg error: {e}")
+        logger.error("FFmpeg error: %s", e)
         return False
 
 
+async def create_sample_video(
+    input_path: Path,
+    output_path: Path,
+    start_time: float,
+    duration: float,
+    width: int,
+    height: int,
+    progress_callback: Optional[Callable[[float], None]] = None,
+    video_codec: Optional[str] = None,
+    audio_codec: Optional[str] = None
+) -> bool:
+    """
+    Create sample video with watermark using FFmpeg
+    Stream-copies the cut instead when the watermark is disabled and the
+    input codecs fit in MP4; otherwise re-encodes without a watermark.
+    A failed hardware encode is retried once with libx264
+    Returns True on success, False on failure
+    """
+    can_copy = (
+        not WATERMARK_ENABLED
+        and video_codec in _MP4_VIDEO_CODECS
+        and (audio_codec is None or audio_codec in _MP4_AUDIO_CODECS)
+    )
+    
+    if can_copy:
+        # No filter to apply: remux the cut without decoding
+        cmd = [
+            *_FFMPEG_PREFIX,
+            "-ss", f"{start_time:.3f}",
+            "-i", str(input_path),
+            "-t", f"{duration:.3f}",
+            *_MAP_ARGS,
+            *_COPY_ARGS,
+            *_FFMPEG_SUFFIX,
+            str(output_path)
+        ]
+        return await _run_ffmpeg(cmd, output_path, duration, progress_callback)
+    
+    encoder = _hw_encoder
+    cmd = _build_encode_cmd(
+        input_path, output_path, start_time, duration,
+        width, height, audio_codec, encoder
+    )
+    if await _run_ffmpeg(cmd, output_path, duration, progress_callback):
+        return True
+    
+    if encoder is None:
+        return False
+    
+    # Session limits or unusual inputs can break the hardware encoder
+    logger.warning("h264_%s encode failed, retrying with libx264", encoder)
+    cmd = _build_encode_cmd(
+        input_path, output_path, start_time, duration,
+        width, height, audio_codec, None
+    )
+    return await _run_ffmpeg(cmd, output_path, duration, progress_callback)
+
+
 def format_progress_bar(progress: float, length: int = 10) -> str:
     """Create a text progress bar"""
     filled = int(progress * length)
@@ -222,7 +464,10 @@ def format_progress_bar(progress: float, length: int = 10) -> str:
     return f"{bar} {percent}%"
 
 
+@functools.lru_cache(maxsize=1024)
 def is_supported_format(filename: str) -> bool:
     """Check if file format is supported"""
-    ext = Path(filename).suffix.lower()
-    return ext in SUPPORTED_FORMATS
+    dot = filename.rfind(".")
+    if dot < 0:
+        return False
+    return filename[dot:].lower() in SUPPORTED_FORMATS